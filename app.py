@@ -3,24 +3,62 @@
 import os
 import io
 import json
-import time
+import uuid
+import hashlib
+import tempfile
+import atexit
 import threading
+import operator
 import traceback
+import concurrent.futures
+from collections import deque
+import httplib2
+import orjson
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import plotly.graph_objects as go
 import plotly.express as px
 import google.generativeai as genai
 from flask import Flask, request, jsonify, session, send_from_directory
+from flask.json.provider import JSONProvider
 from flask_caching import Cache
+from apscheduler.schedulers.background import BackgroundScheduler
 from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.service_account import Credentials as ServiceAccountCredentials
 
 # --- 2. CONFIGURAÇÃO INICIAL DA APLICAÇÃO ---
 
+# Ativa o modo Copy-on-Write do Pandas: filtros e seleções passam a ser "visões" dos dados
+# originais, e uma cópia só é feita quando alguma coluna é realmente modificada.
+pd.set_option('mode.copy_on_write', True)
+
+def converter_para_json(obj):
+    """Converte para JSON os tipos que o orjson não serializa sozinho (ex.: arrays de objetos do NumPy)."""
+    if obj is pd.NaT or obj is pd.NA: return None # Valores nulos do Pandas (datas e colunas do Arrow)
+    if isinstance(obj, np.generic): return obj.item()
+    if hasattr(obj, 'tolist'): return obj.tolist() # Arrays do NumPy/Pandas que não são numéricos
+    raise TypeError(f"Tipo não serializável em JSON: {type(obj).__name__}")
+
+class OrjsonProvider(JSONProvider):
+    """
+    Provedor de JSON do Flask baseado no orjson. Ele serializa arrays do NumPy diretamente,
+    então as especificações dos gráficos podem ser devolvidas pelo jsonify sem conversões extras.
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=converter_para_json, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # Inicializa a aplicação Flask
 app = Flask(__name__)
+app.json = OrjsonProvider(app) # Usa o orjson para ler e gerar todas as respostas JSON
 
-# Define uma chave secreta, essencial para a funcionalidade de 'session' (histórico da conversa)
+# Define uma chave secreta, essencial para a funcionalidade de 'session' (identifica a conversa de cada usuário)
 # É importante que esta chave seja um valor complexo e secreto em um ambiente de produção.
 app.config['SECRET_KEY'] = 'substitua-pela-sua-chave-secreta-aleatoria-e-forte'
 
@@ -32,6 +70,15 @@ cache = Cache(app, config={
     'CACHE_DEFAULT_TIMEOUT': 3600
 })
 
+# Cache separado para os gráficos gerados. Ficar em outra instância impede que muitas
+# perguntas diferentes lotem o cache principal e acabem descartando os dados do get_data().
+# CACHE_THRESHOLD é o número máximo de gráficos guardados; ao passar dele, os mais antigos saem.
+charts_cache = Cache(app, config={
+    'CACHE_TYPE': 'SimpleCache',
+    'CACHE_DEFAULT_TIMEOUT': 3600,
+    'CACHE_THRESHOLD': 1000
+})
+
 # --- 3. CONFIGURAÇÃO DAS APIS E CONSTANTES GLOBAIS ---
 
 # Carrega a chave da API do Gemini a partir das variáveis de ambiente do sistema.
@@ -48,10 +95,63 @@ SCOPES = ['https://www.googleapis.com/auth/drive.readonly'] # Define que nossa a
 CREDENTIALS_FILE = 'credentials.json' # O nome do arquivo com as credenciais da conta de serviço.
 GOOGLE_DRIVE_FOLDER_ID = '1bwIEltfclW0XgRKfLxlIbyKLnJE0No8W' # O ID da sua pasta no Google Drive.
 drive_service = None  # A variável que guardará a conexão com a API do Drive. Será inicializada mais tarde.
+drive_credentials = None  # As credenciais da conta de serviço, reutilizadas pelas threads de download.
+MAX_DOWNLOADS_SIMULTANEOS = 5 # Quantos arquivos CSV são baixados do Drive ao mesmo tempo.
+
+# Arquivos CSV esperados na pasta do Drive e o nome interno de cada DataFrame.
+CSV_FILES = {
+    'parceiros.csv': 'parceiros', 'clientes.csv': 'clientes', 'contas.csv': 'contas',
+    'movimentos_contas.csv': 'movimentos', 'classificacao_ultimo_movimento.csv': 'classificacao'
+}
+
+# Cache em disco. O DataFrame final e cada CSV lido são salvos em Parquet, e o arquivo JSON
+# guarda a data de modificação de cada CSV usado para gerá-los. Enquanto nada mudar no Drive,
+# os dados são lidos direto do disco; quando algo muda, só os CSVs alterados são baixados.
+CACHE_DIR = tempfile.gettempdir()
+CACHE_PARQUET_FILE = os.path.join(CACHE_DIR, 'bi_cache.parquet')
+CACHE_VERSOES_FILE = os.path.join(CACHE_DIR, 'bi_cache.json')
+# Versão do formato do cache em disco (colunas e tipos gerados pelo get_data). Deve ser
+# incrementada sempre que esse formato mudar: caches de outra versão são descartados e refeitos.
+VERSAO_FORMATO_CACHE = 3
+
+# Operadores de comparação aceitos nos filtros dos planos de gráfico.
+OPERADORES_FILTRO = {
+    '==': operator.eq, '!=': operator.ne,
+    '>': operator.gt, '>=': operator.ge,
+    '<': operator.lt, '<=': operator.le,
+}
+
+# Nomes alternativos que a IA às vezes usa para as funções de agregação, traduzidos para os
+# nomes que o Pandas reconhece. Nomes fora da tabela são repassados ao Pandas sem mudança.
+AGREGACOES = {
+    'soma': 'sum', 'total': 'sum',
+    'avg': 'mean', 'average': 'mean', 'media': 'mean', 'média': 'mean',
+    'contagem': 'count',
+    'count_distinct': 'nunique', 'distinct_count': 'nunique',
+    'mediana': 'median',
+}
+
+# Colunas de ID usadas como chave nos merges entre as tabelas.
+COLUNAS_ID = ('ID_Conta', 'ID_Cliente', 'ID_Parceiro')
 
 # Variáveis globais para comunicação entre a thread de atualização e a carga de dados
 csv_modification_times = {} # Dicionário para rastrear a "versão" (data de modificação) de cada arquivo CSV.
 INTERVALO_DE_VERIFICACAO = 60 # Define o intervalo em segundos para a rotina de verificação (aqui, 1 minuto).
+VARIACAO_DA_VERIFICACAO = 5 # Variação aleatória (em segundos) somada ao intervalo, para espalhar as chamadas ao Drive.
+carga_dados_lock = threading.RLock() # Garante que só uma carga dos dados (e gravação do cache em disco) rode por vez.
+_prompt_fragments = {} # Esquema e amostra do DataFrame já formatados para o prompt. Só mudam quando os dados mudam.
+
+# Histórico das conversas, guardado no servidor. A chave é o identificador salvo no cookie
+# da 'session' de cada usuário, e o valor guarda uma fila com os últimos turnos da conversa
+# ('deque') e o mesmo histórico já formatado como texto para o prompt ('text').
+# É um cache limitado: conversas paradas há mais de 1 hora expiram, e no máximo
+# CACHE_THRESHOLD conversas ficam guardadas, para que a memória não cresça sem limite.
+MAX_TURNOS_HISTORICO = 3
+history_store = Cache(app, config={
+    'CACHE_TYPE': 'SimpleCache',
+    'CACHE_DEFAULT_TIMEOUT': 3600,
+    'CACHE_THRESHOLD': 1000
+})
 
 # --- 4. TEMPLATE DO PROMPT PARA O GEMINI ---
 
@@ -101,9 +201,11 @@ PROMPT_TEMPLATE = """
 
 def authenticate_google_drive():
     """Autentica com a API do Google Drive usando as credenciais de conta de serviço."""
+    global drive_credentials # Guarda as credenciais para que os downloads paralelos possam reutilizá-las
     try:
         info = json.load(open(CREDENTIALS_FILE))
         creds = ServiceAccountCredentials.from_service_account_info(info, scopes=SCOPES)
+        drive_credentials = creds
         print("Credenciais do Google Drive carregadas com sucesso.")
         return build('drive', 'v3', credentials=creds)
     except Exception as e:
@@ -113,63 +215,291 @@ def authenticate_google_drive():
 def extrair_json(text):
     """Função de segurança que extrai um bloco JSON de uma string de texto."""
     try:
+        # Trabalha direto sobre os bytes: o orjson aceita bytes e, com o memoryview,
+        # o trecho do JSON é lido sem criar uma cópia da string.
+        data = text.encode('utf-8')
         # Encontra o primeiro '{' e o último '}' para capturar o objeto JSON
-        start_index = text.find('{')
-        end_index = text.rfind('}') + 1
+        start_index = data.find(b'{')
+        end_index = data.rfind(b'}') + 1
         if start_index == -1 or end_index == 0: return None
-        # Converte a string encontrada em um objeto Python (dicionário)
-        return json.loads(text[start_index:end_index])
+        # Converte o trecho encontrado em um objeto Python (dicionário)
+        return orjson.loads(memoryview(data)[start_index:end_index])
     except Exception as e:
         print(f"Erro ao extrair JSON: {e}")
         return None
 
+def formatar_turno(turno):
+    """Formata um turno da conversa do jeito que ele aparece no prompt."""
+    return f"Usuário: {turno['q']}\nAssistente: {turno['a']}"
+
+def registrar_turno(historico, question, answer):
+    """
+    Adiciona um turno ao histórico da conversa e atualiza o texto usado no prompt.
+    Enquanto a fila não está cheia, o novo turno é apenas concatenado ao texto; o texto
+    só é remontado quando a fila descarta o turno mais antigo.
+    """
+    turno = {'q': question, 'a': answer}
+    cheia = len(historico['deque']) == historico['deque'].maxlen
+    historico['deque'].append(turno)
+    if cheia:
+        historico['text'] = "\n".join(formatar_turno(h) for h in historico['deque'])
+    elif historico['text']:
+        historico['text'] += "\n" + formatar_turno(turno)
+    else:
+        historico['text'] = formatar_turno(turno)
+
+def baixar_arquivo_drive(file_id):
+    """
+    Baixa o conteúdo bruto de um arquivo do Google Drive.
+    O objeto Http da biblioteca do Google não é thread-safe, então cada download
+    usa a sua própria conexão autorizada, permitindo rodar vários ao mesmo tempo.
+    """
+    http = AuthorizedHttp(drive_credentials, http=httplib2.Http())
+    return drive_service.files().get_media(fileId=file_id).execute(http=http)
+
+def tipo_pandas_do_arrow(arrow_type):
+    """
+    types_mapper usado em toda conversão de tabelas do Arrow para DataFrame, tanto dos CSVs
+    quanto do cache em Parquet, para que as duas cargas produzam exatamente os mesmos tipos.
+    Textos e números ficam com tipos do Arrow (pd.ArrowDtype); timestamps ficam como
+    datetime64 do NumPy (retornar None usa a conversão padrão).
+    """
+    if pa.types.is_timestamp(arrow_type): return None
+    return pd.ArrowDtype(arrow_type)
+
+def ler_csv(conteudo):
+    """
+    Converte o conteúdo bruto de um CSV em DataFrame usando o leitor do PyArrow,
+    que processa o arquivo em paralelo. As colunas ficam com tipos do Arrow (pd.ArrowDtype),
+    passados ao Pandas sem cópia.
+    """
+    table = pacsv.read_csv(
+        io.BytesIO(conteudo),
+        read_options=pacsv.ReadOptions(use_threads=True, block_size=8 << 20))
+    return table.to_pandas(types_mapper=tipo_pandas_do_arrow, self_destruct=True)
+
+def converter_datas(serie):
+    """
+    Converte uma coluna para datetime64. Colunas que o PyArrow já reconheceu como data
+    são apenas convertidas de tipo, sem passar de novo pelo parser de texto.
+    O que sobra são datas fora do padrão ISO (ex.: '15/01/2024'); nelas o Pandas deduz o
+    formato, considerando o dia antes do mês, como é comum nos dados em português.
+    """
+    if isinstance(serie.dtype, pd.ArrowDtype):
+        arrow_type = serie.dtype.pyarrow_dtype
+        if pa.types.is_date(arrow_type) or pa.types.is_timestamp(arrow_type):
+            return serie.astype('datetime64[ns]')
+    elif pd.api.types.is_datetime64_any_dtype(serie):
+        return serie
+    convertida = pd.to_datetime(serie, dayfirst=True, errors='coerce', cache=True)
+    perdidos = int((convertida.isna() & serie.notna()).sum())
+    if perdidos:
+        print(f"AVISO: {perdidos} valores da coluna '{serie.name}' não puderam ser lidos como data e ficaram vazios.")
+    return convertida
+
+def unificar_categorias(dataframes, coluna):
+    """
+    Converte a coluna de ID para o tipo 'category' em todos os DataFrames que a possuem,
+    usando o mesmo dicionário de categorias em todos eles. Assim o merge compara códigos
+    inteiros em vez de fazer o hash de cada string de ID a cada etapa.
+    """
+    presentes = [df for df in dataframes if coluna in df.columns]
+    if not presentes: return
+    categorias = pd.concat([df[coluna] for df in presentes], ignore_index=True).dropna().unique()
+    for df in presentes:
+        df[coluna] = pd.Categorical(df[coluna], categories=categorias)
+
+def listar_arquivos_csv():
+    """
+    Pede à API do Drive a lista de arquivos CSV da pasta e suas datas de modificação.
+    É uma chamada leve (só metadados), usada tanto na carga dos dados quanto na rotina de verificação.
+    """
+    results = drive_service.files().list(
+        q=f"'{GOOGLE_DRIVE_FOLDER_ID}' in parents and mimeType='text/csv'",
+        fields="files(id, name, modifiedTime)").execute()
+    return [item for item in results.get('files', []) if item['name'].lower() in CSV_FILES]
+
+def caminho_cache_arquivo(df_name):
+    """Retorna o caminho do Parquet em que o CSV de um DataFrame individual é guardado."""
+    return os.path.join(CACHE_DIR, f'bi_cache_{df_name}.parquet')
+
+def ler_versoes_cache():
+    """
+    Retorna as versões (datas de modificação) dos arquivos usados no cache em disco.
+    Retorna None se não houver cache válido (arquivo ausente, ilegível ou gravado com outro
+    formato, ver VERSAO_FORMATO_CACHE): nesse caso todos os arquivos são considerados desatualizados.
+    """
+    try:
+        with open(CACHE_VERSOES_FILE, encoding='utf-8') as f:
+            conteudo = json.load(f)
+        if not isinstance(conteudo, dict) or conteudo.get('formato') != VERSAO_FORMATO_CACHE: return None
+        arquivos = conteudo.get('arquivos')
+        return arquivos if isinstance(arquivos, dict) else None
+    except Exception:
+        return None
+
+def gravar_arquivo_atomico(caminho, escrever):
+    """
+    Grava um arquivo do cache em disco sem que ninguém veja uma versão pela metade:
+    `escrever` recebe um caminho temporário na mesma pasta, e só depois que a gravação
+    termina o arquivo temporário substitui o definitivo (os.replace é atômico).
+    """
+    fd, caminho_temp = tempfile.mkstemp(dir=CACHE_DIR, prefix='bi_cache_', suffix='.tmp')
+    os.close(fd)
+    try:
+        escrever(caminho_temp)
+        os.replace(caminho_temp, caminho)
+    finally:
+        if os.path.exists(caminho_temp): os.remove(caminho_temp)
+
+def salvar_versoes_cache(versoes):
+    """
+    Grava as versões dos arquivos do cache em disco. Deve ser chamada depois de salvar
+    todos os Parquets: se alguma gravação falhar, o cache antigo não será considerado válido.
+    """
+    def escrever(caminho):
+        with open(caminho, 'w', encoding='utf-8') as f:
+            json.dump({'formato': VERSAO_FORMATO_CACHE, 'arquivos': versoes}, f)
+    try:
+        gravar_arquivo_atomico(CACHE_VERSOES_FILE, escrever)
+    except Exception as e:
+        print(f"AVISO: Não foi possível salvar o cache em disco: {e}")
+
+def carregar_cache_parquet(caminho):
+    """Lê um DataFrame salvo em Parquet. Retorna None se o arquivo não existir ou não puder ser lido."""
+    try:
+        if not os.path.exists(caminho): return None
+        table = pq.read_table(caminho)
+        return table.to_pandas(types_mapper=tipo_pandas_do_arrow, self_destruct=True)
+    except Exception as e:
+        print(f"AVISO: Não foi possível ler o cache em disco: {e}")
+        return None
+
+def salvar_cache_parquet(df, caminho):
+    """Salva um DataFrame em Parquet no cache em disco."""
+    try:
+        gravar_arquivo_atomico(caminho, lambda temp: df.to_parquet(temp, engine='pyarrow', compression='zstd'))
+        return True
+    except Exception as e:
+        print(f"AVISO: Não foi possível salvar o cache em disco: {e}")
+        return False
+
+def atualizar_fragmentos_prompt(df):
+    """Pré-calcula os textos do esquema e da amostra de dados usados em todo prompt enviado ao Gemini."""
+    _prompt_fragments['schema'] = df.dtypes.to_string()
+    _prompt_fragments['head'] = df.head(5).to_string()
+
 @cache.memoize()
 def get_data():
     """
-    Busca os dados do Google Drive, processa-os, une-os e retorna o DataFrame final.
+    Retorna o DataFrame final com os dados do Google Drive.
     O decorador @cache.memoize() armazena o resultado. Se a função for chamada novamente,
     o resultado em cache é retornado instantaneamente, em vez de baixar tudo de novo.
+    O lock impede que requisições e a rotina de atualização carreguem os dados ao mesmo tempo.
     """
+    with carga_dados_lock:
+        # Enquanto esta chamada esperava o lock, outra (por exemplo, a rotina de atualização)
+        # pode ter acabado de carregar os dados e guardá-los no cache: nesse caso, reaproveita.
+        final_df = cache.get(get_data.make_cache_key(get_data.uncached))
+        if final_df is not None:
+            return final_df
+        return carregar_dados()
+
+def carregar_dados():
+    """Busca os dados do Google Drive (ou do cache em disco), processa-os, une-os e retorna o DataFrame final."""
     global csv_modification_times # Acessa a variável global para atualizar os tempos dos arquivos
-    print("INICIANDO CARGA COMPLETA DO GOOGLE DRIVE (NÃO DO CACHE)...")
+    print("INICIANDO CARGA DOS DADOS DO GOOGLE DRIVE (NÃO DO CACHE)...")
     if not drive_service: return None
     
     local_dataframes = {}
-    csv_files = {
-        'parceiros.csv': 'parceiros', 'clientes.csv': 'clientes', 'contas.csv': 'contas',
-        'movimentos_contas.csv': 'movimentos', 'classificacao_ultimo_movimento.csv': 'classificacao'
-    }
     
     try:
-        results = drive_service.files().list(
-            q=f"'{GOOGLE_DRIVE_FOLDER_ID}' in parents and mimeType='text/csv'",
-            fields="files(id, name, modifiedTime)").execute()
-        items = results.get('files', [])
-
+        items = listar_arquivos_csv()
+
+        # Se nenhum arquivo mudou desde a última carga, lê o resultado pronto do disco
+        # em vez de baixar e unir todos os CSVs novamente.
+        versoes = {item['name']: item['modifiedTime'] for item in items}
+        # Só usa o atalho se houver arquivos no Drive e um cache válido com exatamente as mesmas versões
+        versoes_em_disco = ler_versoes_cache() or {}
+        if versoes and versoes_em_disco == versoes:
+            final_df = carregar_cache_parquet(CACHE_PARQUET_FILE)
+            if final_df is not None:
+                csv_modification_times.update(versoes)
+                final_df.attrs['data_version'] = hash(frozenset(versoes.items()))
+                atualizar_fragmentos_prompt(final_df)
+                print(">>> DADOS CARREGADOS DO CACHE EM DISCO (PARQUET). <<<")
+                return final_df
+
+        # Os CSVs que não mudaram são lidos do disco; só os alterados são baixados do Drive.
+        items_changed = []
         for item in items:
-            df_name = csv_files.get(item['name'].lower())
-            if not df_name: continue
-            
-            request_file = drive_service.files().get_media(fileId=item['id'])
-            df = pd.read_csv(io.BytesIO(request_file.execute()))
-            csv_modification_times[item['name']] = item['modifiedTime']
-            local_dataframes[df_name] = df
+            df_name = CSV_FILES[item['name'].lower()]
+            df = None
+            if versoes_em_disco.get(item['name']) == item['modifiedTime']:
+                df = carregar_cache_parquet(caminho_cache_arquivo(df_name))
+            if df is None:
+                items_changed.append(item)
+            else:
+                local_dataframes[df_name] = df
+        print(f"Arquivos a baixar do Drive: {[item['name'] for item in items_changed]}")
+
+        # Baixa os CSVs em paralelo: o tempo total passa a ser o do arquivo mais lento,
+        # e não a soma de todos os downloads.
+        cache_completo = True
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_DOWNLOADS_SIMULTANEOS) as executor:
+            futures = {
+                executor.submit(baixar_arquivo_drive, item['id']): item
+                for item in items_changed
+            }
+            for future in concurrent.futures.as_completed(futures):
+                item = futures[future]
+                df_name = CSV_FILES[item['name'].lower()]
+                df = ler_csv(future.result())
+                cache_completo &= salvar_cache_parquet(df, caminho_cache_arquivo(df_name))
+                local_dataframes[df_name] = df
+        csv_modification_times.update(versoes)
         
         # Processamento e Merge dos DataFrames
         df_mov = local_dataframes['movimentos']
         df_class = local_dataframes['classificacao']
         df_class.rename(columns={'Data_Ultimo_Movimento': 'Data_Movimento'}, inplace=True)
         
-        final_df = df_mov.merge(local_dataframes['contas'], on="ID_Conta", how="left") \
-                         .merge(local_dataframes['clientes'], on="ID_Cliente", how="left") \
-                         .merge(df_class, on="ID_Conta", how="left", suffixes=('_mov', '_class')) \
-                         .merge(local_dataframes['parceiros'], on="ID_Parceiro", how="left")
+        for coluna in COLUNAS_ID:
+            unificar_categorias(local_dataframes.values(), coluna)
+
+        # validate='m:1' garante que cada tabela da direita tenha no máximo uma linha por ID,
+        # evitando que uma chave duplicada multiplique silenciosamente as linhas do resultado.
+        merge_opts = dict(how="left", copy=False, validate="m:1", sort=False)
+        final_df = df_mov.merge(local_dataframes['contas'], on="ID_Conta", **merge_opts) \
+                         .merge(local_dataframes['clientes'], on="ID_Cliente", **merge_opts) \
+                         .merge(df_class, on="ID_Conta", suffixes=('_mov', '_class'), **merge_opts) \
+                         .merge(local_dataframes['parceiros'], on="ID_Parceiro", **merge_opts)
+
+        # O tipo 'category' serve só para os merges. Depois deles os IDs voltam ao tipo original,
+        # para que filtros como '>' e a ordenação dos gráficos sigam os valores, e não a ordem das categorias.
+        for coluna in COLUNAS_ID:
+            if coluna in final_df.columns:
+                final_df[coluna] = final_df[coluna].astype(final_df[coluna].cat.categories.dtype)
         
         # Converte todas as colunas que contêm 'Data' em seu nome para o tipo datetime do Pandas
-        for col in final_df.columns:
-            if 'Data' in col:
-                final_df[col] = pd.to_datetime(final_df[col], errors='coerce')
-
+        date_cols = [col for col in final_df.columns if 'Data' in col]
+        if date_cols:
+            final_df[date_cols] = final_df[date_cols].apply(converter_datas)
+
+        # Pré-calcula o mês de cada movimento, usado nos agrupamentos mensais (group_by: ["Ano-Mês"]).
+        # Assim ele é calculado uma vez por carga dos dados, e não a cada gráfico.
+        # Sem a data do movimento, apenas os gráficos mensais deixam de funcionar.
+        if 'Data_Movimento_mov' in final_df.columns:
+            final_df['Ano-Mês'] = final_df['Data_Movimento_mov'].dt.strftime('%Y-%m').astype(pd.ArrowDtype(pa.string()))
+
+        # A versão dos dados viaja junto com o DataFrame (e com ele fica no cache do get_data),
+        # para que cada gráfico seja guardado com a versão dos dados que realmente o gerou.
+        final_df.attrs['data_version'] = hash(frozenset(versoes.items()))
+
+        cache_completo &= salvar_cache_parquet(final_df, CACHE_PARQUET_FILE)
+        if cache_completo:
+            salvar_versoes_cache(versoes)
+        atualizar_fragmentos_prompt(final_df)
         print(">>> DADOS CARREGADOS E PROCESSADOS COM SUCESSO. <<<")
         return final_df
 
@@ -177,67 +507,150 @@ def get_data():
         print(f"ERRO CRÍTICO durante a carga de dados: {e}"); traceback.print_exc()
         return None
 
+def chave_cache_grafico(plan, data_version):
+    """
+    Monta a chave do cache de um gráfico. A chave combina o plano (normalizado, com as chaves
+    em ordem) e a versão dos dados usados no gráfico, então perguntas iguais reaproveitam
+    o gráfico até que algum arquivo mude no Drive.
+    """
+    return 'grafico_' + hashlib.blake2b(
+        orjson.dumps(plan, option=orjson.OPT_SORT_KEYS) + str(data_version).encode()).hexdigest()
+
+def gerar_graficos(plans, df_original):
+    """
+    Gera as especificações de todos os gráficos pedidos em uma resposta, na mesma ordem dos planos.
+    Gráficos já gerados são lidos do cache. Planos que pedem a mesma transformação dos dados
+    (mesmos filtros, agrupamento, eixo X e cor) reaproveitam o resultado calculado para o primeiro deles,
+    então filtros e agrupamentos rodam uma vez só por transformação.
+    """
+    specs = []
+    transformados = {}
+    data_version = df_original.attrs.get('data_version')
+    for plan in plans:
+        # Um plano malformado descarta só o próprio gráfico, e não a resposta inteira
+        try:
+            chave = chave_cache_grafico(plan, data_version)
+            spec = charts_cache.get(chave)
+            if spec is not None:
+                print(f"Gráfico encontrado no cache: {plan.get('title')}")
+            else:
+                chave_transformacao = orjson.dumps(
+                    [plan.get('data_transformation'), plan.get('color'), plan.get('x_axis')],
+                    option=orjson.OPT_SORT_KEYS)
+                if chave_transformacao not in transformados:
+                    transformados[chave_transformacao] = transformar_dados_grafico(plan, df_original)
+                spec = plotar_grafico(transformados[chave_transformacao], plan)
+                if spec is not None:
+                    charts_cache.set(chave, spec)
+        except Exception as e:
+            print(f"ERRO FATAL ao gerar gráfico dinâmico: {e}"); traceback.print_exc()
+            continue
+        if spec is not None:
+            specs.append(spec)
+    return specs
+
 # <<< VERSÃO FINAL E FLEXÍVEL >>>
-def gerar_grafico_plotly(plan, df_original):
+def transformar_dados_grafico(plan, df_original):
     """
-    Gera a especificação JSON de um gráfico Plotly a partir de um plano.
+    Aplica a transformação de dados de um plano (filtros e agrupamento) e retorna
+    uma tupla (df_agg, agg_col), ou None se não houver dados para o gráfico.
     Esta versão é flexível para lidar com pequenas variações na resposta da IA.
     """
     try:
         print(f"--- Iniciando Geração de Gráfico (Modo Manual Robusto) ---"); print(f"Plano recebido: {plan}")
-        df = df_original.copy()
         transformation = plan.get('data_transformation')
         if not transformation: return None
 
+        agg_info = transformation.get('aggregation', {})
+        # <<< CORREÇÃO: Lida com agregação em formato de dicionário >>>
+        if isinstance(agg_info, dict) and len(agg_info) == 1:
+             agg_col = next(iter(agg_info))
+             agg_func = agg_info[agg_col]
+        else:
+             agg_col, agg_func = agg_info.get('column'), agg_info.get('function')
+
+        # 0. Seleciona só as colunas que o gráfico usa (filtros, agrupamento, agregação, eixo X e cor).
+        # Com Copy-on-Write essa seleção não copia os dados, e as etapas seguintes
+        # percorrem um DataFrame bem mais estreito que o original.
+        x_axis = plan.get('x_axis')
+        needed = [f.get('column') for f in transformation.get('filters', [])]
+        needed += list(transformation.get('group_by', []))
+        needed += x_axis if isinstance(x_axis, list) else [x_axis]
+        needed += [agg_col, plan.get('color')]
+        df = df_original[[col for col in dict.fromkeys(needed) if col in df_original.columns]]
+
         # 1. Filtros
+        # Cada filtro gera uma máscara booleana; no final todas são combinadas com AND
+        # e o DataFrame é filtrado uma única vez.
         filters = transformation.get('filters', [])
+        masks = []
         for f in filters:
             # <<< CORREÇÃO AQUI: O código agora entende 'operator' E 'condition' >>>
             column = f['column']
-            operator = f.get('operator') or f.get('condition') # Pega o que existir
+            operador = f.get('operator') or f.get('condition') # Pega o que existir
             value = f.get('value') or f.get('values')
 
-            if not operator: # Pula o filtro se não houver operador
+            if not operador: # Pula o filtro se não houver operador
                 print(f"AVISO: Filtro para coluna '{column}' sem operador. Pulando.")
                 continue
 
             if "Data" in column and not pd.api.types.is_datetime64_any_dtype(df[column]):
-                df[column] = pd.to_datetime(df[column], errors='coerce')
+                df = df.assign(**{column: pd.to_datetime(df[column], errors='coerce')})
             
-            print(f"Aplicando filtro: {column} {operator} {value}")
-            if operator == 'between' and isinstance(value, list) and len(value) == 2:
+            print(f"Aplicando filtro: {column} {operador} {value}")
+            if operador == 'between' and isinstance(value, list) and len(value) == 2:
                 start_date, end_date = pd.to_datetime(value[0]), pd.to_datetime(value[1])
-                df = df[df[column].between(start_date, end_date)]
-            elif operator == 'in' and isinstance(value, list):
-                df = df[df[column].isin(value)]
+                mask = df[column].between(start_date, end_date)
+            elif operador in ('in', 'not in', '==', '!=') and (operador in ('in', 'not in') or isinstance(value, list)):
+                # 'in'/'not in' aceitam um valor único; '=='/'!=' com uma lista significam "está/não está na lista"
+                values = value if isinstance(value, list) else [value]
+                mask = df[column].isin(values)
+                if operador in ('not in', '!='): mask = ~mask
+            elif operador in OPERADORES_FILTRO:
+                mask = OPERADORES_FILTRO[operador](df[column], value)
             else:
-                df = df.query(f"`{column}` {operator} @value", local_dict={'value': value})
+                # Ignorar o filtro desenharia o gráfico com dados não filtrados (um gráfico errado);
+                # é melhor não gerar este gráfico.
+                print(f"ERRO: Filtro não suportado na coluna '{column}': {operador} {value}. Gráfico descartado.")
+                return None
+            # Valores nulos (NA) na comparação contam como "não passou no filtro"
+            masks.append(mask.to_numpy(dtype=bool, na_value=False))
+
+        if masks:
+            df = df[np.logical_and.reduce(masks)]
         
         if df.empty: return None
 
         # 2. Agrupamento
-        group_by_cols = transformation.get('group_by', [])
-        agg_info = transformation.get('aggregation', {})
-        # <<< CORREÇÃO: Lida com agregação em formato de dicionário >>>
-        if isinstance(agg_info, dict) and len(agg_info) == 1:
-             agg_col = next(iter(agg_info))
-             agg_func = agg_info[agg_col]
-        else:
-             agg_col, agg_func = agg_info.get('column'), agg_info.get('function')
+        # Cópia da lista: adicionar a coluna de cor não deve alterar o plano recebido
+        group_by_cols = list(transformation.get('group_by', []))
         
         color_col = plan.get('color')
         if color_col and color_col not in group_by_cols: group_by_cols.append(color_col)
         
-        if 'Ano-Mês' in group_by_cols:
-            df['Ano-Mês'] = df['Data_Movimento_mov'].dt.to_period('M').astype(str)
-        
         if group_by_cols and agg_col and agg_func:
-            df_agg = df.groupby(list(set(group_by_cols))).agg({agg_col: agg_func}).reset_index()
+            # dict.fromkeys remove duplicados mantendo a ordem pedida no plano.
+            # observed=True evita gerar grupos para combinações de categorias que não existem nos dados.
+            keys = list(dict.fromkeys(group_by_cols))
+            agg_func = AGREGACOES.get(str(agg_func).lower(), agg_func)
+            df_agg = df.groupby(keys, sort=False, observed=True, as_index=False).agg({agg_col: agg_func})
         else:
             df_agg = df
             
         if df_agg.empty: return None
-        
+        return df_agg, agg_col
+    except Exception as e:
+        print(f"ERRO FATAL ao transformar os dados do gráfico: {e}"); traceback.print_exc()
+        return None
+
+def plotar_grafico(transformado, plan):
+    """
+    Gera a especificação JSON de um gráfico Plotly a partir dos dados já transformados
+    (o resultado de transformar_dados_grafico) e do restante do plano.
+    """
+    if transformado is None: return None
+    df_agg, agg_col = transformado
+    try:
         chart_type, title, x_axis, y_axis = plan.get('chart_type'), plan.get('title'), plan.get('x_axis'), agg_col
         color_col = plan.get('color')
         fig = None
@@ -295,54 +708,52 @@ def gerar_grafico_plotly(plan, df_original):
                     x=0.01           # Coloca a âncora em 1% da largura (bem na esquerda)
                 )
             )
-            return json.loads(fig.to_json())
+            # to_plotly_json() já devolve um dicionário; o jsonify (via orjson) cuida da serialização
+            return fig.to_plotly_json()
         return None
     except Exception as e:
         print(f"ERRO FATAL ao gerar gráfico dinâmico: {e}"); traceback.print_exc()
         return None
         
 # --- 6. ROTINA DE ATUALIZAÇÃO EM SEGUNDO PLANO ---
-def verificar_atualizacoes_periodicamente():
+def verificar_atualizacoes():
     """
-    Esta função roda em uma thread separada em um loop infinito,
-    verificando o Google Drive por mudanças em intervalos regulares.
+    Esta função é executada pelo agendador (APScheduler) em intervalos regulares,
+    verificando o Google Drive por mudanças nos arquivos CSV.
     """
     global csv_modification_times # Acessa o dicionário global para comparar as datas de modificação
 
-    while True:
-        # Pausa a execução pelo tempo definido na constante INTERVALO_DE_VERIFICACAO
-        time.sleep(INTERVALO_DE_VERIFICACAO)
-        print("\nVerificando atualizações no Google Drive...")
+    print("\nVerificando atualizações no Google Drive...")
 
-        # Se a conexão com o Drive não foi estabelecida, pula esta verificação
-        if not drive_service:
-            continue
-        
-        try:
-            # Pede à API do Drive a lista de arquivos CSV e suas datas de modificação
-            results = drive_service.files().list(
-                q=f"'{GOOGLE_DRIVE_FOLDER_ID}' in parents and mimeType='text/csv'",
-                fields="files(id, name, modifiedTime)").execute()
-            items = results.get('files', [])
-
-            for item in items:
-                # Compara a data de modificação do arquivo no Drive com a data que temos guardada
-                if item['name'] in csv_modification_times and csv_modification_times[item['name']] != item['modifiedTime']:
-                    print(f"Mudança detectada em '{item['name']}'. Limpando o cache.")
-                    
-                    # Se houver mudança, limpa todo o cache da aplicação.
-                    # A próxima vez que um usuário fizer uma pergunta, a função get_data()
-                    # será forçada a baixar os dados novos do Drive.
-                    cache.clear()
-                    
-                    # Chama get_data() para recarregar os dados imediatamente e atualizar
-                    # os tempos de modificação, evitando limpezas repetidas.
-                    get_data() 
-                    
-                    # Sai do loop 'for' pois o cache já foi limpo.
-                    break 
-        except Exception as e:
-            print(f"Erro na rotina de verificação periódica: {e}")
+    # Se a conexão com o Drive não foi estabelecida, pula esta verificação
+    if not drive_service:
+        return
+    
+    try:
+        # Compara a data de modificação de cada arquivo no Drive com a data que temos guardada
+        alterados = [
+            item['name'] for item in listar_arquivos_csv()
+            if item['name'] in csv_modification_times and csv_modification_times[item['name']] != item['modifiedTime']
+        ]
+        if alterados:
+            print(f"Mudança detectada em {alterados}. Limpando o cache.")
+            
+            # O lock é mantido da limpeza até o fim da recarga: requisições que chegarem
+            # nesse meio-tempo esperam os dados novos em vez de iniciar outra carga em paralelo.
+            with carga_dados_lock:
+                # Se houver mudança, limpa todo o cache da aplicação.
+                # A próxima vez que um usuário fizer uma pergunta, a função get_data()
+                # será forçada a carregar os dados novos.
+                cache.clear()
+                charts_cache.clear()
+                _prompt_fragments.clear()
+                
+                # Chama get_data() para recarregar os dados imediatamente e atualizar
+                # os tempos de modificação, evitando limpezas repetidas.
+                # Só os arquivos alterados são baixados; os demais vêm do cache em disco.
+                get_data()
+    except Exception as e:
+        print(f"Erro na rotina de verificação periódica: {e}")
 
 # --- 7. ROTAS DA APLICAÇÃO WEB (FLASK) ---
 
@@ -370,9 +781,11 @@ def ask_gemini():
     if df is None:
         return jsonify({"answer": "Desculpe, os dados não estão disponíveis no momento para análise."}), 500
     
-    # 2. Gerenciar o histórico da conversa usando a 'session' do Flask
-    if 'history' not in session:
-        session['history'] = []
+    # 2. Gerenciar o histórico da conversa. O histórico fica no servidor; o cookie da
+    # 'session' do Flask guarda apenas um identificador curto da conversa.
+    if 'sid' not in session:
+        session['sid'] = uuid.uuid4().hex
+    session.pop('history', None) # Remove o histórico dos cookies antigos, que o guardavam inteiro
     
     # 3. Extrair a pergunta do corpo da requisição JSON enviada pelo JavaScript
     data = request.get_json()
@@ -380,12 +793,17 @@ def ask_gemini():
     if not question:
         return jsonify({"answer": "Por favor, faça uma pergunta."}), 400
 
+    # O histórico só é criado depois que a pergunta foi validada.
+    # A deque descarta sozinha o turno mais antigo ao passar de MAX_TURNOS_HISTORICO.
+    history = history_store.get(session['sid']) or {'deque': deque(maxlen=MAX_TURNOS_HISTORICO), 'text': ''}
+
     # 4. Preparar todas as partes do prompt para o Gemini
-    conversation_history = "\n".join([f"Usuário: {h['q']}\nAssistente: {h['a']}" for h in session['history']])
+    # O esquema e a amostra de dados já foram formatados na carga dos dados; só são
+    # recalculados aqui se o cache tiver acabado de ser limpo pela rotina de atualização.
     prompt = PROMPT_TEMPLATE.format(
-        conversation_history=conversation_history,
-        schema_info=df.dtypes.to_string(), # Envia os tipos de dados das colunas
-        data_summary=df.head(5).to_string(), # Envia as 5 primeiras linhas como exemplo
+        conversation_history=history['text'], # Histórico já formatado a cada turno registrado
+        schema_info=_prompt_fragments.get('schema') or df.dtypes.to_string(), # Envia os tipos de dados das colunas
+        data_summary=_prompt_fragments.get('head') or df.head(5).to_string(), # Envia as 5 primeiras linhas como exemplo
         question=question
     )
     
@@ -402,15 +820,14 @@ def ask_gemini():
         chart_plans = response_json.get("chart_plans", [])
         
         # 6. Gera os gráficos com base nos planos recebidos
-        # Usa uma "list comprehension" para criar a lista de especificações de gráficos
-        charts_json = [spec for plan in chart_plans if (spec := gerar_grafico_plotly(plan, df)) is not None]
+        # Planos com a mesma transformação dos dados compartilham o mesmo processamento
+        charts_json = gerar_graficos(chart_plans, df)
         
         # 7. Atualiza o histórico da conversa com a pergunta atual e a resposta
-        session['history'].append({'q': question, 'a': text_answer})
-        # Mantém o histórico com no máximo os 3 últimos turnos da conversa
-        if len(session['history']) > 3:
-            session['history'].pop(0)
-        session.modified = True
+        # (a deque mantém apenas os 3 últimos turnos da conversa)
+        registrar_turno(history, question, text_answer)
+        # O cache guarda uma cópia do valor, então o histórico atualizado precisa ser gravado de volta
+        history_store.set(session['sid'], history)
         
         # 8. Retorna a resposta completa para o JavaScript no formato JSON
         return jsonify({
@@ -434,14 +851,20 @@ if __name__ == '__main__':
         print("Realizando carga inicial dos dados para o cache...")
         get_data() 
         
-        # Cria e inicia a thread que vai verificar por atualizações nos arquivos
-        # em segundo plano, sem travar a aplicação principal.
+        # Agenda a verificação de atualizações nos arquivos para rodar em segundo plano,
+        # sem travar a aplicação principal. max_instances=1 impede que duas verificações
+        # rodem ao mesmo tempo caso uma recarga demore mais que o intervalo.
         print("Iniciando a rotina de verificação de atualizações em segundo plano...")
-        update_thread = threading.Thread(target=verificar_atualizacoes_periodicamente, daemon=True)
-        update_thread.start()
+        scheduler = BackgroundScheduler(daemon=True)
+        scheduler.add_job(
+            verificar_atualizacoes, 'interval',
+            seconds=INTERVALO_DE_VERIFICACAO, jitter=VARIACAO_DA_VERIFICACAO,
+            max_instances=1, coalesce=True)
+        scheduler.start()
+        atexit.register(lambda: scheduler.shutdown(wait=False))
     
     # Inicia o servidor Flask. 
-    # use_reloader=False é essencial para que a thread de atualização não seja duplicada.
+    # use_reloader=False é essencial para que a rotina de atualização não seja duplicada.
     print("Servidor Flask iniciado. Acesse http://127.0.0.1:5000 no seu navegador.")
     app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
 